@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 '''
 Kubernetes external inventory script
@@ -31,7 +31,7 @@ When run against a specific host, this script returns the following variables:
     - podCIDR (optional)
     - externalID
     - nodeinfo :dict
-    - public_ip (The first public IP found)
+    - public_ip (The first public IP found, or empty string if none)
     - private_ip (The first private IP found, or empty string if none)
 
 Peter Sankauskas did most of the legwork here with his linode plugin; Dan Slimmon
@@ -59,10 +59,13 @@ adapted that for Linode and I adapted Dan Slimmon's work for kubernetes.
 ######################################################################
 
 # Standard imports
+import mmap
 import os
 import subprocess
 import re
+import shutil
 import sys
+import tempfile
 import argparse
 from time import time
 
@@ -71,10 +74,42 @@ try:
 except ImportError:
     import simplejson as json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Imports for ansible
-import ConfigParser
+try:
+    from configparser import ConfigParser as SafeConfigParser
+except ImportError:
+    from ConfigParser import SafeConfigParser
+
+
+def json_loads(data):
+    """Parses JSON from a str or bytes-like object."""
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+
+def json_dumps(data, pretty=False):
+    """Serializes data to JSON and returns it as UTF-8 encoded bytes."""
+    if orjson is not None:
+        if pretty:
+            return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+        return orjson.dumps(data)
+    if pretty:
+        return json.dumps(data, sort_keys=True, indent=2).encode('utf-8')
+    return json.dumps(data).encode('utf-8')
+
 
 class K8sInventory(object):
+    # Characters that are invalid in an ansible group name
+    _SAFE_RE = re.compile(r"[^A-Za-z0-9\-]")
+
     def _empty_inventory(self):
         return {"_meta": {"hostvars": {}}}
 
@@ -88,8 +123,8 @@ class K8sInventory(object):
         # # Local cache of Datacenter objects populated by populate_datacenter_cache()
         # self._datacenter_cache = None
 
-        # Initialize empty node labels
-        self.node_labels = {}
+        # Serialized inventory as last written to the cache file
+        self._inventory_bytes = None
 
         # # Read settings and parse CLI arguments
         self.read_settings()
@@ -106,10 +141,11 @@ class K8sInventory(object):
             data_to_print = self.get_host_info()
         elif self.args.list:
             # Display list of nodes for inventory
-            if len(self.inventory) == 1:
-                data_to_print = self.get_inventory_from_cache()
+            if self._inventory_bytes is not None:
+                self.print_bytes(self._inventory_bytes)
             else:
-                data_to_print = self.json_format_dict(self.inventory, True)
+                self.print_inventory_from_cache()
+            return
 
         print(data_to_print)
 
@@ -125,7 +161,7 @@ class K8sInventory(object):
 
     def read_settings(self):
         """Reads the settings from the .ini file."""
-        config = ConfigParser.SafeConfigParser()
+        config = SafeConfigParser()
         config.read(os.path.dirname(os.path.realpath(__file__)) + '/kube.ini')
 
         # Cache related
@@ -150,77 +186,73 @@ class K8sInventory(object):
     def do_api_calls_update_cache(self):
         """Do API calls, and save data in cache files."""
         self.get_nodes()
-        self.write_to_cache(self.inventory, self.cache_path_cache)
+        self._inventory_bytes = self.write_to_cache(self.inventory, self.cache_path_cache)
         self.write_to_cache(self.index, self.cache_path_index)
 
     def get_nodes(self):
         """Calls kubectl to get the list of nodes."""
-        cmd = [ "bash", "-c", "kubectl get nodes -ojson | jq '.items'" ]
+        cmd = ["kubectl", "get", "nodes", "-o", "json"]
 
         try:
-            nodes = json.loads(subprocess.check_output(cmd))
+            nodes = json_loads(subprocess.check_output(cmd))["items"]
 
-            # load node labels hash
             for node in nodes:
                 self.add_node(node)
-                for label in node["metadata"]["labels"]:
-                    self.node_labels[label] = 1
         except subprocess.CalledProcessError as e:
             sys.exit("Looks like kubectl is broken:\n %s" % e)
 
+    def get_node_cmd(self, id):
+        """Returns the kubectl command that fetches a specific node."""
+        return ["kubectl", "get", "node", id, "-o", "json"]
+
     def get_node(self, id):
         """Gets details about a specific node."""
-        cmd = ['bash', '-c', 'kubectl get node %s -ojson' % id]
+        cmd = self.get_node_cmd(id)
         try:
-            node = json.loads(subprocess.check_output(cmd))
+            node = json_loads(subprocess.check_output(cmd))
             return node
         except subprocess.CalledProcessError as err:
-            sys.exit("kubectl error\n%s" % e)
-
-    def get_node_label(self, node, label):
-        if label in node["metadata"]["labels"]:
-            return node["metadata"]["labels"][label]
-        else:
-            return ""
+            sys.exit("kubectl error\n%s" % err)
 
     def get_node_name(self, node):
         return node["metadata"]["name"]
 
-    def add_node(self, node):
-        """Adds an node to the inventory and index."""
+    def get_node_dest(self, node, addrs):
+        """Returns the inventory hostname used for the node."""
         if self.use_public_ip:
-            dest = self.get_node_public_ip(node)
+            return addrs.get('ExternalIP', '')
         elif self.use_private_ip:
-            dest = self.get_node_private_ip(node)
+            return addrs.get('InternalIP', '')
         else:
-            dest = self.get_node_name(node)
+            return self.get_node_name(node)
+
+    def add_node(self, node):
+        """Adds an node to the inventory and index."""
+        addrs = self.get_node_addresses(node)
+        dest = self.get_node_dest(node, addrs)
 
         # Add to index
         self.index[dest] = self.get_node_name(node)
 
         self.push(self.inventory, 'all', dest)
 
-        # Inventory: Group by all node labels
-        for label in self.node_labels:
-            self.push(self.inventory, self.get_node_label(node, label), dest)
+        # Inventory: Group by the node's own label values, or by the label
+        # key for empty-valued labels such as node-role.kubernetes.io/master
+        for key, value in node["metadata"].get("labels", {}).items():
+            self.push(self.inventory, self.to_safe(value or key), dest)
 
         # Inventory: Group by display group
         # self.push(self.inventory, node.display_group, dest)
 
         # Add host info to hostvars
-        self.inventory["_meta"]["hostvars"][dest] = self._get_host_info(node)
-
-    def get_node_public_ip(self, node):
-        """Returns a the public IP address of the node"""
-        for addr in node['status']['addresses']:
-            if addr['type'] == 'ExternalIP':
-                return addr['address']
+        self.inventory["_meta"]["hostvars"][dest] = self._get_host_info(node, addrs)
 
-    def get_node_private_ip(self, node):
-        """Returns a the private IP address of the node"""
-        for addr in node['status']['addresses']:
-            if addr['type'] == 'InternalIP':
-                return addr['address']
+    def get_node_addresses(self, node):
+        """Returns a dict of the first address of each type found on the node"""
+        addrs = {}
+        for addr in node.get('status', {}).get('addresses', []):
+            addrs.setdefault(addr['type'], addr['address'])
+        return addrs
 
     def get_host_info(self):
         """Get variables about a specific host."""
@@ -230,41 +262,83 @@ class K8sInventory(object):
             self.load_index_from_cache()
 
         if self.args.host not in self.index:
-            # try updating the cache
+            # Hosts named after their node can be fetched on their own before
+            # updating the whole cache; IP hostnames can't be looked up by name
+            if not (self.use_public_ip or self.use_private_ip):
+                if self._refresh_single(self.args.host) is not None:
+                    return self.json_format_dict(self.inventory["_meta"]["hostvars"][self.args.host], True)
+
             self.do_api_calls_update_cache()
             if self.args.host not in self.index:
                 # host might not exist anymore
                 return self.json_format_dict({}, True)
 
+            # The refresh just built this host's variables
+            return self.json_format_dict(self.inventory["_meta"]["hostvars"][self.args.host], True)
+
         node_id = self.index[self.args.host]
         node = self.get_node(node_id)
 
         return self.json_format_dict(self._get_host_info(node), True)
 
-    def _get_host_info(self, node):
-        node_vars = {
-            'annotations': node['metadata']['annotations'],
-            'labels': node['metadata']['labels'],
-            'addresses': node['status']['addresses'],
-            'allocatable': node['status']['allocatable'],
-            'capacity': node['status']['capacity'],
-            # 'nodeinfo': node['status']['nodeinfo'],
-        }
+    def _refresh_single(self, host):
+        """Fetches a single node and updates its entries in the cache files.
+
+        Returns the node, or None if there is no inventory cache to update or
+        kubectl does not know a node by that name.
+        """
+        if not os.path.isfile(self.cache_path_cache):
+            # Nothing to patch, so a full refresh is needed anyway
+            return None
 
-        if 'taints' in node['spec']:
-            node_vars['taints'] = node['spec']['taints']
+        cmd = self.get_node_cmd(host)
+        try:
+            node = json_loads(subprocess.check_output(cmd, stderr=subprocess.DEVNULL))
+        except subprocess.CalledProcessError:
+            return None
+
+        if len(self.inventory) == 1:
+            self.inventory = json_loads(self.get_inventory_from_cache())
+
+        # Drop stale group memberships before adding the node again
+        for group in list(self.inventory):
+            if group != '_meta' and host in self.inventory[group]:
+                self.inventory[group].remove(host)
+                if not self.inventory[group]:
+                    del self.inventory[group]
+
+        self.add_node(node)
+
+        # Keep the inventory's original mtime so a partial update does not
+        # extend the lifetime of the rest of the cached cluster
+        cache_stat = os.stat(self.cache_path_cache)
+        self._inventory_bytes = self.write_to_cache(self.inventory, self.cache_path_cache)
+        os.utime(self.cache_path_cache, (cache_stat.st_atime, cache_stat.st_mtime))
+        self.write_to_cache(self.index, self.cache_path_index)
+        return node
 
-        if 'podCIDR' in node['spec']:
-            node_vars['podCIDR'] = node['spec']['podCIDR']
+    def _get_host_info(self, node, addrs=None):
+        metadata = node.get('metadata', {})
+        status = node.get('status', {})
+        spec = node.get('spec', {})
 
-        if 'providerID' in node['spec']:
-            node_vars['providerID'] = node['spec']['providerID']
+        node_vars = {
+            'annotations': metadata.get('annotations', {}),
+            'labels': metadata.get('labels', {}),
+            'addresses': status.get('addresses', []),
+            'allocatable': status.get('allocatable', {}),
+            'capacity': status.get('capacity', {}),
+            # 'nodeinfo': status.get('nodeInfo', {}),
+        }
 
-        if 'externalID' in node['spec']:
-            node_vars['externalID'] = node['spec']['externalID']
+        for key in ('taints', 'podCIDR', 'providerID', 'externalID'):
+            if key in spec:
+                node_vars[key] = spec[key]
 
-        node_vars["public_ip"] = self.get_node_public_ip(node)
-        node_vars["private_ip"] = self.get_node_private_ip(node)
+        if addrs is None:
+            addrs = self.get_node_addresses(node)
+        node_vars["public_ip"] = addrs.get('ExternalIP', '')
+        node_vars["private_ip"] = addrs.get('InternalIP', '')
 
         # Set the SSH host information, so these inventory items can be used if
         # their labels aren't FQDNs
@@ -272,7 +346,7 @@ class K8sInventory(object):
         if self.use_public_ip:
             ssh_ip = node_vars['public_ip']
 
-        elif self.use_public_ip:
+        elif self.use_private_ip:
             ssh_ip = node_vars['private_ip']
 
         if ssh_ip == '':
@@ -285,39 +359,86 @@ class K8sInventory(object):
 
     def push(self, my_dict, key, element):
         """Pushed an element onto an array that may not have been defined in the dict."""
-        if key in my_dict:
-            my_dict[key].append(element)
-        else:
-            my_dict[key] = [element]
+        my_dict.setdefault(key, []).append(element)
 
     def get_inventory_from_cache(self):
         """Reads the inventory from the cache file and returns it as a JSON object."""
-        cache = open(self.cache_path_cache, 'r')
-        json_inventory = cache.read()
-        return json_inventory
+        with open(self.cache_path_cache, 'rb') as cache:
+            return cache.read()
+
+    def _stdout_bytes(self):
+        """Returns a binary stream for stdout, flushing any pending text first."""
+        sys.stdout.flush()
+        return sys.stdout.buffer if hasattr(sys.stdout, 'buffer') else sys.stdout
+
+    def print_bytes(self, data):
+        """Writes already serialized JSON to stdout."""
+        out = self._stdout_bytes()
+        out.write(data)
+        out.write(b'\n')
+        out.flush()
+
+    def print_inventory_from_cache(self):
+        """Copies the cached inventory straight to stdout without decoding it."""
+        out = self._stdout_bytes()
+        with open(self.cache_path_cache, 'rb') as cache:
+            size = os.fstat(cache.fileno()).st_size
+            try:
+                offset = 0
+                while offset < size:
+                    sent = os.sendfile(out.fileno(), cache.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+            except (AttributeError, OSError, ValueError):
+                # No sendfile, or stdout is not a real file descriptor
+                cache.seek(offset)
+                shutil.copyfileobj(cache, out)
+        out.write(b'\n')
+        out.flush()
 
     def load_index_from_cache(self):
         """Reads the index from the cache file and sets self.index."""
-        cache = open(self.cache_path_index, 'r')
-        json_index = cache.read()
-        self.index = json.loads(json_index)
+        with open(self.cache_path_index, 'rb') as cache:
+            try:
+                index_map = mmap.mmap(cache.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files cannot be mapped
+                self.index = json_loads(cache.read())
+                return
+        view = memoryview(index_map)
+        try:
+            self.index = json_loads(view)
+        finally:
+            view.release()
+            index_map.close()
 
     def write_to_cache(self, data, filename):
-        """Writes data in JSON format to a file."""
-        json_data = self.json_format_dict(data, True)
-        cache = open(filename, 'w')
-        cache.write(json_data)
-        cache.close()
+        """Writes data in compact JSON format to a file, replacing it atomically.
+
+        Returns the bytes that were written.
+        """
+        json_data = json_dumps(data)
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as cache:
+                # mkstemp creates the file 0600; keep the usual umask-based mode
+                umask = os.umask(0)
+                os.umask(umask)
+                os.fchmod(cache.fileno(), 0o666 & ~umask)
+                cache.write(json_data)
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            os.unlink(tmp_filename)
+            raise
+        return json_data
 
     def to_safe(self, word):
         """Escapes any characters that would be invalid in an ansible group name."""
-        return re.sub("[^A-Za-z0-9\-]", "_", word)
+        return self._SAFE_RE.sub("_", word)
 
     def json_format_dict(self, data, pretty=False):
         """Converts a dict to a JSON object and dumps it as a formatted string."""
-        if pretty:
-            return json.dumps(data, sort_keys=True, indent=2)
-        else:
-            return json.dumps(data)
+        return json_dumps(data, pretty).decode('utf-8')
 
 K8sInventory()